@@ -0,0 +1,35 @@
+import sqlite3
+from contextlib import contextmanager
+
+# Applied to every connection: WAL lets the Gemini stage read while the OCR stage writes,
+# and synchronous=NORMAL skips most of the fsyncs a commit would otherwise wait on.
+CONNECTION_PRAGMAS = """
+    PRAGMA journal_mode=WAL;
+    PRAGMA synchronous=NORMAL;
+    PRAGMA temp_store=MEMORY;
+    PRAGMA cache_size=-65536;
+    PRAGMA busy_timeout=5000;
+    PRAGMA foreign_keys=ON;
+"""
+
+
+def open_db(path):
+    """
+    Opens the pipeline's SQLite database with the tuning PRAGMAs above.
+    The connection is in autocommit mode, so group writes with transaction().
+    """
+    conn = sqlite3.connect(path, isolation_level=None)
+    conn.executescript(CONNECTION_PRAGMAS)
+    return conn
+
+
+@contextmanager
+def transaction(conn):
+    """Runs the enclosed writes inside BEGIN IMMEDIATE ... COMMIT, rolling back on error."""
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        yield conn.cursor()
+    except BaseException:
+        conn.execute("ROLLBACK")
+        raise
+    conn.execute("COMMIT")
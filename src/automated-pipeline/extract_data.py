@@ -1,100 +1,649 @@
-import sqlite3
-import google.generativeai as genai
+import argparse
+import asyncio
+import hashlib
+from google import genai
+from google.genai import errors as genai_errors, types
 import json
+import math
 import os
+import tempfile
 import time
+from collections import deque
+from statistics import mean
 from dotenv import load_dotenv
 
+from db import open_db, transaction
+from retrying import transient_retry
+
 # Load variables from the .env file into the environment
 load_dotenv()
 
 # --- Configuration ---
 DB_FILE = 'ocr_data.db'
 
+# Models used for the two passes over each document.
+ROUTER_MODEL_NAME = 'models/gemini-2.5-flash-lite'
+EXTRACT_MODEL_NAME = 'models/gemini-flash-latest'
+
+# Relevance is decided first by comparing an embedding of the document's opening text with
+# RELEVANCE_PROTOTYPE. Only scores between the two thresholds are sent to the LLM router.
+EMBED_MODEL_NAME = 'models/gemini-embedding-001'
+EMBED_CONFIG = types.EmbedContentConfig(task_type='SEMANTIC_SIMILARITY')
+EMBED_BATCH_SIZE = 100        # texts per embed_content request
+EMBED_RELEVANT_SCORE = 0.50   # cosine similarity above this is relevant
+EMBED_IRRELEVANT_SCORE = 0.40 # cosine similarity below this is irrelevant
+
+# Only the start of each document is used for routing, to save costs.
+ROUTER_TEXT_CHARS = 3000
+
+# How often (in seconds) to check on a submitted batch job.
+BATCH_POLL_INTERVAL = 30
+BATCH_DONE_STATES = {'JOB_STATE_SUCCEEDED', 'JOB_STATE_PARTIALLY_SUCCEEDED', 'JOB_STATE_FAILED',
+                     'JOB_STATE_CANCELLED', 'JOB_STATE_EXPIRED'}
+# Done states that still come with an output file; a partial one has an error line for each failed request.
+BATCH_OUTPUT_STATES = {'JOB_STATE_SUCCEEDED', 'JOB_STATE_PARTIALLY_SUCCEEDED'}
+
+# Concurrency limits for the online (non-batch) mode.
+AIMD_INITIAL_LIMIT = 4        # in-flight requests at startup
+AIMD_MAX_LIMIT = 16           # never go above this many in-flight requests
+AIMD_WINDOW = 32              # successful calls averaged before growing the limit
+AIMD_LATENCY_TARGET = 5.0     # seconds; only grow while calls stay this fast
+
+# HTTP status codes that mean "slow down" rather than "this request is broken".
+THROTTLE_CODES = {429, 503}
+
 # --- IMPORTANT: Configure Gemini API Key ---
 GEMINI_API_KEY = os.getenv("GEMINI_API_KEY")
 if not GEMINI_API_KEY:
     raise ValueError("Error: GEMINI_API_KEY not found in .env file or environment variables.")
 
-genai.configure(api_key=GEMINI_API_KEY)
+# One client for the whole run. Online calls go through client.aio, whose HTTP
+# client keeps connections open across records; batch jobs use the sync side.
+client = genai.Client(api_key=GEMINI_API_KEY)
+
+
+class AIMDLimiter:
+    """
+    Caps the number of in-flight Gemini calls.
+    The cap is halved whenever the API throttles us and grows by one after every
+    window of successful calls whose mean latency stays under the target.
+    """
+
+    def __init__(self, initial=AIMD_INITIAL_LIMIT, max_limit=AIMD_MAX_LIMIT,
+                 window=AIMD_WINDOW, latency_target=AIMD_LATENCY_TARGET):
+        self.limit = initial
+        self.max_limit = max_limit
+        self.latency_target = latency_target
+        self.latencies = deque(maxlen=window)
+        self.in_flight = 0
+        self._last_decrease = 0.0
+        self._cond = asyncio.Condition()
+
+    async def __aenter__(self):
+        async with self._cond:
+            await self._cond.wait_for(lambda: self.in_flight < self.limit)
+            self.in_flight += 1
+        return self
+
+    async def __aexit__(self, *exc_info):
+        async with self._cond:
+            self.in_flight -= 1
+            self._cond.notify_all()
+
+    def record_success(self, latency):
+        """Additive increase: one more slot per healthy window."""
+        self.latencies.append(latency)
+        if len(self.latencies) == self.latencies.maxlen and mean(self.latencies) <= self.latency_target:
+            self.limit = min(self.max_limit, self.limit + 1)
+            self.latencies.clear()
+
+    def record_throttle(self, started):
+        """Multiplicative decrease, applied once per burst of throttled calls."""
+        # Calls that were already in flight when we last backed off report the
+        # same congestion; counting each of them would collapse the limit to 1.
+        if started < self._last_decrease:
+            return
+        self.limit = max(1, int(self.limit * 0.5))
+        self.latencies.clear()
+        self._last_decrease = time.monotonic()
+        print(f"    !! Throttled by the API. Concurrency limit is now {self.limit}.")
+
+
+def _is_throttle(exc):
+    """True for API errors that ask us to slow down."""
+    return isinstance(exc, genai_errors.APIError) and exc.code in THROTTLE_CODES
+
+
+@transient_retry(_is_throttle)
+async def call_with_backoff(limiter, call):
+    """
+    Awaits call() under the limiter. Throttled calls shrink the limit and are retried with
+    backoff; the wait happens outside the limiter so the slot is free for other work.
+    """
+    async with limiter:
+        started = time.monotonic()
+        try:
+            response = await call()
+        except genai_errors.APIError as e:
+            if _is_throttle(e):
+                limiter.record_throttle(started)
+            raise
+        limiter.record_success(time.monotonic() - started)
+        return response
+
+
+async def generate(limiter, model_name, prompt):
+    """Runs one generate_content call under the limiter."""
+    return await call_with_backoff(limiter, lambda: client.aio.models.generate_content(
+        model=model_name, contents=prompt
+    ))
+
+
+def setup_cache_table(conn):
+    """Creates the table that remembers Gemini results by document_cache_key()."""
+    with transaction(conn) as cursor:
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS gemini_cache (
+                cache_key TEXT PRIMARY KEY,
+                router_result INTEGER,
+                gemini_json TEXT
+            )
+        ''')
 
 
 def fetch_records_to_process(conn):
     """Fetches records from the DB that are ready for processing."""
     cursor = conn.cursor()
+    # Two index lookups on (status, gemini_status); an OR here would scan the whole table.
     cursor.execute("""
                    SELECT pdf_id, pdf_name, ocr_text
                    FROM documents
                    WHERE status = 'ocr_complete'
-                     AND (gemini_status IS NULL OR gemini_status = 'gemini_error')
+                     AND gemini_status IS NULL
+                   UNION ALL
+                   SELECT pdf_id, pdf_name, ocr_text
+                   FROM documents
+                   WHERE status = 'ocr_complete'
+                     AND gemini_status = 'gemini_error'
                    """)
     return cursor.fetchall()
 
 
-def is_document_relevant(ocr_text, pdf_name):
+# Every prompt is STATIC_PREFIX, then the fixed instructions for its task, then the document
+# text last. Keeping the unchanging part first lets Gemini's implicit prompt caching reuse
+# it across documents once the instructions are long enough to qualify.
+STATIC_PREFIX = """
+    You are reviewing public documents from Southampton County, VA: Board of Supervisors and
+    Planning Commission minutes, agendas, staff reports and land use applications.
+    The text was produced by OCR of scanned PDFs, so expect broken lines, page headers and
+    occasional misread characters.
+
+    Topics of interest are specific land use projects, construction, solar projects,
+    conditional or special use permits, rezonings and the votes taken on them.
+    Base every answer only on the document text you are given.
     """
-    Uses a cheap, fast prompt to check if the document is relevant for full analysis.
-    Returns True if relevant, False otherwise.
+
+# What a relevant document reads like; its embedding is the reference point for routing.
+RELEVANCE_PROTOTYPE = """
+    County Board of Supervisors and Planning Commission minutes discussing an application for a
+    conditional use permit or special use permit for a utility-scale solar energy facility.
+    The applicant, project name, megawatts, acreage, parcel tax map numbers and location are
+    presented, public comments are heard, and the board votes to approve or deny the permit,
+    rezoning or comprehensive plan (2232) review.
     """
-    print(f"  > Routing '{pdf_name}'...")
-    try:
-        model = genai.GenerativeModel('models/gemini-2.5-flash-lite')
 
-        prompt = f"""
-        Does the following text from a public document appear to contain a discussion, application, or vote related to a specific land use project, construction, solar project, or zoning change? 
-        Answer only with the single word YES or NO.
+ROUTER_INSTRUCTIONS = """
+    Does the document text below appear to contain a discussion, application, or vote related to a specific land use project, construction, solar project, or zoning change?
+    Answer only with the single word YES or NO.
+    """
+
+EXTRACTION_INSTRUCTIONS = """
+    Analyze the document text below...
+    (Your full detailed prompt goes here)
+    """
+
+
+def build_router_prompt(ocr_text):
+    """Builds the cheap YES/NO relevance prompt for one document."""
+    return f"""{STATIC_PREFIX}{ROUTER_INSTRUCTIONS}
+    ---
+    {ocr_text[:ROUTER_TEXT_CHARS]}
+    ---
+    """
+
+
+def build_extraction_prompt(ocr_text):
+    """Builds the full structured-extraction prompt for one document."""
+    return f"""{STATIC_PREFIX}{EXTRACTION_INSTRUCTIONS}
+    ---
+    {ocr_text}
+    ---
+    """
+
+
+def pipeline_fingerprint():
+    """
+    Hashes everything besides the OCR text that shapes a document's result: the models,
+    the prompt templates, and the embedding prototype and thresholds.
+    """
+    parts = [
+        ROUTER_MODEL_NAME, EXTRACT_MODEL_NAME, EMBED_MODEL_NAME,
+        repr(EMBED_RELEVANT_SCORE), repr(EMBED_IRRELEVANT_SCORE), RELEVANCE_PROTOTYPE,
+        build_router_prompt(''), build_extraction_prompt(''),
+    ]
+    return hashlib.sha256('\0'.join(parts).encode('utf-8')).hexdigest()
+
+
+def document_cache_key(fingerprint, ocr_text):
+    """Cache key for one document's result: its OCR text under the current pipeline_fingerprint()."""
+    return hashlib.sha256(f"{fingerprint}\0{ocr_text or ''}".encode('utf-8')).hexdigest()
+
+
+def cosine_similarity(a, b):
+    """Cosine of the angle between two vectors."""
+    norm = math.sqrt(math.fsum(x * x for x in a)) * math.sqrt(math.fsum(y * y for y in b))
+    return math.fsum(x * y for x, y in zip(a, b)) / norm if norm else 0.0
+
+
+def embedding_verdict(embedding, prototype):
+    """
+    Returns (relevant, score): relevant is True or False when the similarity to the prototype
+    is decisive, and None when it is borderline or missing and the LLM router should decide.
+    """
+    if embedding is None or prototype is None:
+        return None, None
+    score = cosine_similarity(embedding, prototype)
+    if score > EMBED_RELEVANT_SCORE:
+        return True, score
+    if score < EMBED_IRRELEVANT_SCORE:
+        return False, score
+    return None, score
+
+
+def is_blank(text):
+    """True for texts with nothing to embed, such as scans Vision found no text on."""
+    return not (text and text.strip())
+
+
+async def embed_texts(limiter, texts):
+    """
+    Embeds texts in chunks of EMBED_BATCH_SIZE. Returns one vector per text, None where the
+    text is blank or its chunk failed.
+    """
+    vectors = [None] * len(texts)
+    # A single empty text can fail a whole request, so blank ones are never sent.
+    indexed = [(i, text) for i, text in enumerate(texts) if not is_blank(text)]
+
+    async def embed_chunk(chunk):
+        try:
+            response = await call_with_backoff(limiter, lambda: client.aio.models.embed_content(
+                model=EMBED_MODEL_NAME, contents=[text for _, text in chunk], config=EMBED_CONFIG
+            ))
+        except Exception as e:
+            print(f"    !! Embedding request failed ({e}). Those documents go to the LLM router.")
+            return
+        for (i, _), embedding in zip(chunk, response.embeddings):
+            vectors[i] = embedding.values
+
+    chunks = [indexed[i:i + EMBED_BATCH_SIZE] for i in range(0, len(indexed), EMBED_BATCH_SIZE)]
+    await asyncio.gather(*(embed_chunk(chunk) for chunk in chunks))
+    return vectors
+
+
+def print_embedding_verdict(pdf_name, relevant, score):
+    """Logs the outcome of embedding-based routing for one document."""
+    if relevant is None:
+        if score is not None:
+            print(f"    - '{pdf_name}' is borderline (score {score:.2f}). Asking the LLM router.")
+    elif relevant:
+        print(f"    - Result: '{pdf_name}' is relevant (score {score:.2f}). Proceeding to full analysis.")
+    else:
+        print(f"    - Result: '{pdf_name}' is irrelevant (score {score:.2f}). Skipping.")
+
+
+def parse_router_answer(text):
+    """Returns True if the router model answered YES."""
+    return "YES" in text.upper()
+
 
-        ---
-        {ocr_text[:3000]} 
-        ---
-        """  # We only send the first 3000 characters to save costs
+def parse_extraction_response(text):
+    """Strips markdown fences from a model response and parses it as JSON."""
+    json_string = text.strip().replace('```json', '').replace('```', '')
+    return json.loads(json_string)
 
-        response = model.generate_content(prompt)
 
-        if "YES" in response.text.upper():
-            print("    - Result: Relevant. Proceeding to full analysis.")
+async def is_document_relevant(limiter, model_name, ocr_text, pdf_name):
+    """
+    Uses a cheap, fast prompt to check if the document is relevant for full analysis.
+    Returns True if relevant, False otherwise, and None if the router call itself failed.
+    """
+    print(f"  > Routing '{pdf_name}'...")
+    try:
+        response = await generate(limiter, model_name, build_router_prompt(ocr_text))
+
+        if parse_router_answer(response.text):
+            print(f"    - Result: '{pdf_name}' is relevant. Proceeding to full analysis.")
             return True
         else:
-            print("    - Result: Irrelevant. Skipping.")
+            print(f"    - Result: '{pdf_name}' is irrelevant. Skipping.")
             return False
 
     except Exception as e:
-        print(f"    !! Router prompt failed for '{pdf_name}': {e}. Skipping as a precaution.")
-        return False
+        print(f"    !! Router prompt failed for '{pdf_name}': {e}. It will be retried on the next run.")
+        return None
 
 
-def extract_structured_data(ocr_text, pdf_name):
+async def extract_structured_data(limiter, model_name, ocr_text, pdf_name):
     """Sends OCR'd text to Gemini and asks for specific structured data."""
     print(f"  > Analyzing '{pdf_name}' with Gemini...")
-    model = genai.GenerativeModel('models/gemini-flash-latest')
-    # ... (The detailed prompt remains the same as before) ...
-    prompt = f"""
-    Analyze the following text from a Southampton County, VA, public document...
-    (Your full detailed prompt goes here)
-    """
 
     try:
-        response = model.generate_content(prompt)
-        json_string = response.text.strip().replace('```json', '').replace('```', '')
-        return json.loads(json_string)
+        response = await generate(limiter, model_name, build_extraction_prompt(ocr_text))
+        return parse_extraction_response(response.text)
     except Exception as e:
-        print(f"    !! Gemini API or JSON parsing error: {e}")
+        print(f"    !! Gemini API or JSON parsing error for '{pdf_name}': {e}")
         return {"error": str(e), "raw_response": response.text if 'response' in locals() else "No response"}
 
 
+def submit_batch_file(create_job, requests_by_key, display_name):
+    """
+    Uploads one JSONL line per key, submits it with create_job(file_name, config) and waits for
+    the job to finish. Returns the parsed output lines, or None if the job produced no output.
+    """
+    try:
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            src_path = os.path.join(tmp_dir, f"{display_name}.jsonl")
+            with open(src_path, 'w', encoding='utf-8') as f:
+                for key, request in requests_by_key.items():
+                    f.write(json.dumps({"key": key, "request": request}) + "\n")
+
+            uploaded = client.files.upload(
+                file=src_path, config={'display_name': display_name, 'mime_type': 'jsonl'}
+            )
+    except Exception as e:
+        print(f"    !! Could not upload the input for batch job '{display_name}': {e}")
+        return None
+
+    try:
+        batch_job = create_job(uploaded.name, {'display_name': display_name})
+    except Exception as e:
+        print(f"    !! Could not create batch job '{display_name}': {e}")
+        # Nothing will read the uploaded input now; don't leave it behind.
+        try:
+            client.files.delete(name=uploaded.name)
+        except Exception:
+            pass
+        return None
+    print(f"  > Submitted batch job {batch_job.name} ({len(requests_by_key)} requests).")
+
+    while batch_job.state.name not in BATCH_DONE_STATES:
+        time.sleep(BATCH_POLL_INTERVAL)
+        batch_job = client.batches.get(name=batch_job.name)
+        print(f"    - {batch_job.name}: {batch_job.state.name}")
+
+    if batch_job.state.name not in BATCH_OUTPUT_STATES:
+        print(f"    !! Batch job {batch_job.name} ended with {batch_job.state.name}: {batch_job.error}")
+        return None
+    if batch_job.state.name == 'JOB_STATE_PARTIALLY_SUCCEEDED':
+        print(f"    !! Batch job {batch_job.name} only partially succeeded. Failed requests are reported per document.")
+
+    content = client.files.download(file=batch_job.dest.file_name)
+    return [json.loads(line) for line in content.decode('utf-8').splitlines() if line.strip()]
+
+
+def run_batch_job(model_name, prompts_by_key, display_name):
+    """
+    Submits one Gemini Batch API job containing a prompt per key and waits for it.
+    Returns {key: response_text or Exception}, or None if the job itself did not succeed.
+    """
+    items = submit_batch_file(
+        lambda file_name, config: client.batches.create(model=model_name, src=file_name, config=config),
+        {key: {"contents": [{"parts": [{"text": prompt}]}]} for key, prompt in prompts_by_key.items()},
+        display_name,
+    )
+    if items is None:
+        return None
+
+    results = {}
+    for item in items:
+        try:
+            parts = item['response']['candidates'][0]['content']['parts']
+            results[item['key']] = "".join(part.get('text', '') for part in parts)
+        except (KeyError, IndexError) as e:
+            results[item['key']] = Exception(item.get('error') or f"Malformed batch response: {e}")
+    return results
+
+
+def run_embedding_batch_job(texts_by_key, display_name):
+    """
+    Submits one Batch API embeddings job containing a text per key and waits for it.
+    Returns {key: vector}, leaving out blank texts and keys whose request failed, or None if the job did not succeed.
+    """
+    # Blank texts are left out, as in embed_texts().
+    requests_by_key = {
+        key: {"content": {"parts": [{"text": text}]}, "task_type": EMBED_CONFIG.task_type}
+        for key, text in texts_by_key.items() if not is_blank(text)
+    }
+    if not requests_by_key:
+        return {}
+    # Unlike batches.create, create_embeddings only takes the input file as an EmbeddingsBatchJobSource.
+    items = submit_batch_file(
+        lambda file_name, config: client.batches.create_embeddings(
+            model=EMBED_MODEL_NAME, src={'file_name': file_name}, config=config
+        ),
+        requests_by_key,
+        display_name,
+    )
+    if items is None:
+        return None
+
+    results = {}
+    for item in items:
+        try:
+            results[item['key']] = item['response']['embedding']['values']
+        except KeyError:
+            pass
+    return results
+
+
+def encode_result(json_result):
+    """Serializes a result for storage. Compact, since only code reads it back; pretty-print on read if needed."""
+    return json.dumps(json_result, separators=(',', ':'))
+
+
 def update_database_with_result(conn, pdf_id, json_result, status):
     """Updates the database with the result and new status."""
+    with transaction(conn) as cursor:
+        cursor.execute(
+            "UPDATE documents SET gemini_json = ?, gemini_status = ? WHERE pdf_id = ?",
+            (encode_result(json_result), status, pdf_id)
+        )
+
+
+def group_uncached_records(conn, records):
+    """
+    Applies cached results to records whose exact OCR text was analyzed before with the same
+    models and prompts. Returns the remaining records grouped by cache key, so each distinct
+    text is sent to Gemini once.
+    """
     cursor = conn.cursor()
-    cursor.execute(
-        "UPDATE documents SET gemini_json = ?, gemini_status = ? WHERE pdf_id = ?",
-        (json.dumps(json_result, indent=2), status, pdf_id)
+    fingerprint = pipeline_fingerprint()
+    groups = {}
+    for record in records:
+        pdf_id, pdf_name, ocr_text = record
+        cache_key = document_cache_key(fingerprint, ocr_text)
+        cursor.execute("SELECT router_result, gemini_json FROM gemini_cache WHERE cache_key = ?", (cache_key,))
+        cached = cursor.fetchone()
+        if cached:
+            router_result, gemini_json = cached
+            update_database_with_result(conn, pdf_id, json.loads(gemini_json),
+                                        'gemini_complete' if router_result else 'irrelevant')
+            print(f"  > ✅ Reused cached result for '{pdf_name}'.")
+        else:
+            groups.setdefault(cache_key, []).append(record)
+    return groups
+
+
+# Stored for documents whose relevance could not be decided because the router call failed.
+ROUTER_ERROR_RESULT = {"error": "Router call failed"}
+
+
+def save_group_result(conn, cache_key, group, json_result, status, relevant):
+    """Stores one Gemini result for every record sharing the same OCR text, and caches it."""
+    # Errors, including failed router calls, are stored as gemini_error and not cached,
+    # so fetch_records_to_process picks them up again on the next run.
+    if relevant is not None and status != 'gemini_error':
+        with transaction(conn) as cursor:
+            cursor.execute(
+                "INSERT OR REPLACE INTO gemini_cache (cache_key, router_result, gemini_json) VALUES (?, ?, ?)",
+                (cache_key, int(relevant), encode_result(json_result))
+            )
+
+    for pdf_id, pdf_name, _ in group:
+        update_database_with_result(conn, pdf_id, json_result, status)
+        if status == 'irrelevant':
+            print(f"  > ✅ Marked '{pdf_name}' as irrelevant in the database.")
+        else:
+            print(f"  > ✅ Successfully updated database for '{pdf_name}'.")
+
+
+async def run_online(conn, groups):
+    """Processes record groups with concurrent Gemini calls, paced by an AIMD limiter."""
+    limiter = AIMDLimiter()
+
+    # --- EMBEDDING ROUTER ---
+    # One embedding per distinct document, compared against the prototype embedded alongside them.
+    print("\nEmbedding documents for routing...")
+    prototype, *embeddings = await embed_texts(
+        limiter, [RELEVANCE_PROTOTYPE] + [(group[0][2] or '')[:ROUTER_TEXT_CHARS] for group in groups.values()]
     )
-    conn.commit()
+
+    async def process(cache_key, group, embedding):
+        _, pdf_name, ocr_text = group[0]
+        print(f"\nProcessing: {pdf_name}")
+
+        # --- ROUTER LOGIC ---
+        # First, check if the document is relevant. Borderline scores are left to the LLM router.
+        relevant, score = embedding_verdict(embedding, prototype)
+        print_embedding_verdict(pdf_name, relevant, score)
+        if relevant is None:
+            relevant = await is_document_relevant(limiter, ROUTER_MODEL_NAME, ocr_text, pdf_name)
+        if relevant is None:
+            # The router call failed; record it as an error so the document is retried.
+            save_group_result(conn, cache_key, group, ROUTER_ERROR_RESULT, 'gemini_error', None)
+        elif relevant:
+            # If it's relevant, perform the full extraction.
+            structured_data = await extract_structured_data(limiter, EXTRACT_MODEL_NAME, ocr_text, pdf_name)
+            status = 'gemini_error' if 'error' in structured_data else 'gemini_complete'
+            save_group_result(conn, cache_key, group, structured_data, status, relevant)
+        else:
+            # If not relevant, mark it as such and skip.
+            save_group_result(conn, cache_key, group, {"status": "irrelevant"}, 'irrelevant', relevant)
+
+    await asyncio.gather(*(
+        process(cache_key, group, embedding)
+        for (cache_key, group), embedding in zip(groups.items(), embeddings)
+    ))
+
+
+def run_batch(conn, groups):
+    """Processes record groups with Gemini Batch API jobs: embedding, routing of borderline documents, then extraction."""
+    texts = {cache_key: group[0][2] for cache_key, group in groups.items()}
+
+    # --- EMBEDDING ROUTER PASS ---
+    # Every distinct document is embedded in a single batch job; the prototype is embedded once.
+    print("\nEmbedding documents with the Batch API...")
+    try:
+        prototype = client.models.embed_content(
+            model=EMBED_MODEL_NAME, contents=RELEVANCE_PROTOTYPE, config=EMBED_CONFIG
+        ).embeddings[0].values
+    except Exception as e:
+        print(f"    !! Could not embed the relevance prototype ({e}). All documents go to the LLM router.")
+        prototype = None
+    embeddings = run_embedding_batch_job(
+        {cache_key: (ocr_text or '')[:ROUTER_TEXT_CHARS] for cache_key, ocr_text in texts.items()},
+        'embedding-router-pass',
+    ) or {}
+
+    relevant_hashes = []
+    borderline_hashes = []
+    for cache_key, group in groups.items():
+        pdf_name = group[0][1]
+        relevant, score = embedding_verdict(embeddings.get(cache_key), prototype)
+        print_embedding_verdict(pdf_name, relevant, score)
+        if relevant is None:
+            borderline_hashes.append(cache_key)
+        elif relevant:
+            relevant_hashes.append(cache_key)
+        else:
+            save_group_result(conn, cache_key, group, {"status": "irrelevant"}, 'irrelevant', False)
+
+    # --- ROUTER PASS ---
+    # Documents the embeddings could not decide go through the cheap YES/NO prompt in a single batch job.
+    router_results = {}
+    if borderline_hashes:
+        print(f"\nRouting {len(borderline_hashes)} borderline documents with the Batch API...")
+        router_results = run_batch_job(
+            ROUTER_MODEL_NAME,
+            {cache_key: build_router_prompt(texts[cache_key]) for cache_key in borderline_hashes},
+            'router-pass',
+        )
+        if router_results is None:
+            # Leave the borderline documents unprocessed so the next run retries them.
+            borderline_hashes = []
+
+    for cache_key in borderline_hashes:
+        group = groups[cache_key]
+        pdf_name = group[0][1]
+        answer = router_results.get(cache_key, Exception("No response in batch output"))
+        if isinstance(answer, Exception):
+            print(f"    !! Router prompt failed for '{pdf_name}': {answer}. It will be retried on the next run.")
+            save_group_result(conn, cache_key, group, ROUTER_ERROR_RESULT, 'gemini_error', None)
+        elif parse_router_answer(answer):
+            relevant_hashes.append(cache_key)
+        else:
+            # If not relevant, mark it as such and skip.
+            save_group_result(conn, cache_key, group, {"status": "irrelevant"}, 'irrelevant', False)
+
+    if not relevant_hashes:
+        return
+
+    # --- EXTRACTION PASS ---
+    # Only the relevant documents are sent for the full extraction.
+    print(f"\nExtracting structured data from {len(relevant_hashes)} relevant documents...")
+    extract_results = run_batch_job(
+        EXTRACT_MODEL_NAME,
+        {cache_key: build_extraction_prompt(texts[cache_key]) for cache_key in relevant_hashes},
+        'extraction-pass',
+    )
+    if extract_results is None:
+        return
+
+    for cache_key in relevant_hashes:
+        group = groups[cache_key]
+        pdf_name = group[0][1]
+        response_text = extract_results.get(cache_key, Exception("No response in batch output"))
+        try:
+            if isinstance(response_text, Exception):
+                raise response_text
+            structured_data = parse_extraction_response(response_text)
+        except Exception as e:
+            print(f"    !! Gemini API or JSON parsing error for '{pdf_name}': {e}")
+            raw = response_text if isinstance(response_text, str) else "No response"
+            structured_data = {"error": str(e), "raw_response": raw}
+        status = 'gemini_error' if 'error' in structured_data else 'gemini_complete'
+        save_group_result(conn, cache_key, group, structured_data, status, True)
 
 
 # --- Main Script Execution ---
 if __name__ == "__main__":
-    conn = sqlite3.connect(DB_FILE)
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--batch", action="store_true",
+                    help="Submit all records as Gemini Batch API jobs (half price, results can take hours)")
+    args = ap.parse_args()
+
+    conn = open_db(DB_FILE)
+    setup_cache_table(conn)
 
     records_to_process = fetch_records_to_process(conn)
 
@@ -102,25 +651,13 @@ if __name__ == "__main__":
         print("No new records found for processing.")
     else:
         print(f"Found {len(records_to_process)} records to process.")
-
-        for record in records_to_process:
-            pdf_id, pdf_name, ocr_text = record
-            print(f"\nProcessing: {pdf_name}")
-
-            # --- ROUTER LOGIC ADDED ---
-            # First, check if the document is relevant.
-            if is_document_relevant(ocr_text, pdf_name):
-                # If it's relevant, perform the full extraction.
-                structured_data = extract_structured_data(ocr_text, pdf_name)
-                update_database_with_result(conn, pdf_id, structured_data,
-                                            'gemini_error' if 'error' in structured_data else 'gemini_complete')
-                print(f"  > ✅ Successfully updated database for '{pdf_name}'.")
-            else:
-                # If not relevant, mark it as such and skip.
-                update_database_with_result(conn, pdf_id, {"status": "irrelevant"}, 'irrelevant')
-                print(f"  > ✅ Marked '{pdf_name}' as irrelevant in the database.")
-
-            time.sleep(31)
+        groups = group_uncached_records(conn, records_to_process)
+        if not groups:
+            print("All records were answered from the cache.")
+        elif args.batch:
+            run_batch(conn, groups)
+        else:
+            asyncio.run(run_online(conn, groups))
 
     conn.close()
     print("\n\n🎉 All processing complete.")
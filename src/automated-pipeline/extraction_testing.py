@@ -1,14 +1,23 @@
 import os
 import io
-import sqlite3
-from google.auth.transport.requests import Request
+import json
+import re
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from google.auth.transport.requests import AuthorizedSession, Request
 from google.oauth2.credentials import Credentials
 from google_auth_oauthlib.flow import InstalledAppFlow
 from googleapiclient.discovery import build
 from googleapiclient.errors import HttpError
-from googleapiclient.http import MediaIoBaseDownload
+from google.api_core import exceptions as google_exceptions
 from google.cloud import vision
 
+from db import open_db, transaction
+from retrying import transient_retry
+
 # --- Configuration ---
 # 1. This is the Folder ID from your Google Drive URL.
 DRIVE_FOLDER_ID = '1o7u6u0_29MVBnuV0gPRf0y7pWkJgheIg'
@@ -22,30 +31,95 @@ DB_FILE = 'ocr_data.db'
 # 4. Google API Scopes - we only need to read files.
 SCOPES = ['https://www.googleapis.com/auth/drive.readonly']
 
+# 5. How many OCR results to collect before writing them in one transaction.
+DB_FLUSH_EVERY = 16
+
+# 6. How many files to download and OCR at once, and the most Vision API calls per second.
+OCR_WORKERS = 8
+VISION_MAX_RPS = 10
+
+# 7. Optional Cloud Storage bucket for Vision's asynchronous batch OCR. When set, PDFs are
+#    staged there and OCR'd several files per request, without the 5-page limit that
+#    synchronous requests have. Leave as None to OCR each file with a synchronous request.
+GCS_BUCKET = None
+VISION_FILES_PER_BATCH = 5
+VISION_ASYNC_TIMEOUT = 1800  # seconds to wait for one asynchronous batch
+
+# 8. Drive media download endpoint and the size of each chunk read from it.
+DRIVE_MEDIA_URL = 'https://www.googleapis.com/drive/v3/files/{file_id}?alt=media'
+DRIVE_DOWNLOAD_CHUNK = 1024 * 1024
+
 # --- Set up authentication for the Vision API ---
 os.environ['GOOGLE_APPLICATION_CREDENTIALS'] = SERVICE_ACCOUNT_FILE
 
 
 def setup_database():
-    """Creates the SQLite database and table if they don't exist."""
-    conn = sqlite3.connect(DB_FILE)
-    cursor = conn.cursor()
-    # The status column will track our progress for each file.
-    cursor.execute('''
-        CREATE TABLE IF NOT EXISTS documents (
-            id INTEGER PRIMARY KEY,
-            pdf_id TEXT UNIQUE NOT NULL,
-            pdf_name TEXT NOT NULL,
-            ocr_text TEXT,
-            status TEXT NOT NULL
-        )
-    ''')
-    conn.commit()
+    """Creates the SQLite database, table and indexes if they don't exist."""
+    conn = open_db(DB_FILE)
+    with transaction(conn) as cursor:
+        # The status column will track our progress for each file.
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS documents (
+                id INTEGER PRIMARY KEY,
+                pdf_id TEXT UNIQUE NOT NULL,
+                pdf_name TEXT NOT NULL,
+                ocr_text TEXT,
+                status TEXT NOT NULL,
+                gemini_json TEXT,
+                gemini_status TEXT
+            )
+        ''')
+        # Databases created before the Gemini stage existed lack its columns.
+        columns = {row[1] for row in cursor.execute("PRAGMA table_info(documents)")}
+        for column in ('gemini_json', 'gemini_status'):
+            if column not in columns:
+                cursor.execute(f"ALTER TABLE documents ADD COLUMN {column} TEXT")
+        # Lets extract_data.py find its work without scanning the whole table.
+        cursor.execute("CREATE INDEX IF NOT EXISTS idx_docs_status ON documents (status, gemini_status)")
     conn.close()
 
 
-def get_drive_service():
-    """Handles Google Drive authentication and returns a service object."""
+def flush_rows(conn, rows):
+    """Writes pending document rows in a single transaction and clears the list."""
+    if not rows:
+        return
+    with transaction(conn) as cursor:
+        cursor.executemany(
+            "INSERT OR REPLACE INTO documents (pdf_id, pdf_name, ocr_text, status) VALUES (?, ?, ?, ?)",
+            rows
+        )
+    rows.clear()
+
+
+class RateLimiter:
+    """Token bucket shared across threads that lets at most `rate` calls per second through."""
+
+    def __init__(self, rate):
+        self.rate = rate
+        self.tokens = rate
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        """Blocks until a call is allowed."""
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.rate, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
+
+# requests sessions are not thread-safe, so each worker thread keeps its own Drive session.
+_thread_local = threading.local()
+
+
+def get_drive_credentials():
+    """Handles Google Drive authentication and returns the user's credentials."""
     creds = None
     if os.path.exists('token.json'):
         creds = Credentials.from_authorized_user_file('token.json', SCOPES)
@@ -57,12 +131,41 @@ def get_drive_service():
             creds = flow.run_local_server(port=0)
         with open('token.json', 'w') as token:
             token.write(creds.to_json())
-    return build('drive', 'v3', credentials=creds)
+    return creds
+
+
+def get_drive_session(creds):
+    """
+    Returns an authorized requests session for the current thread. It keeps its connection
+    to Drive open, so later downloads skip the TCP and TLS handshakes.
+    """
+    if getattr(_thread_local, 'drive_session', None) is None:
+        _thread_local.drive_session = AuthorizedSession(creds)
+    return _thread_local.drive_session
 
 
-def ocr_pdf_content(pdf_content):
+def download_pdf(creds, pdf_id, pdf_name):
+    """Downloads a Drive file into memory and returns its bytes."""
+    url = DRIVE_MEDIA_URL.format(file_id=pdf_id)
+    fh = io.BytesIO()
+    with get_drive_session(creds).get(url, stream=True) as response:
+        response.raise_for_status()
+        for chunk in response.iter_content(chunk_size=DRIVE_DOWNLOAD_CHUNK):
+            fh.write(chunk)
+    print(f"'{pdf_name}': downloaded {fh.tell() // 1024} KB.")
+    return fh.getvalue()
+
+
+def is_transient_vision_error(exc):
+    """True for Vision API errors that mean "slow down" rather than "this request is broken"."""
+    return isinstance(exc, (google_exceptions.ResourceExhausted, google_exceptions.ServiceUnavailable))
+
+
+@transient_retry(is_transient_vision_error)
+def ocr_pdf_content(client, pdf_content, rate_limiter):
     """Sends PDF content to the Vision API and returns the extracted text."""
-    client = vision.ImageAnnotatorClient()
+    # Taken on every attempt, so retries after throttling also respect VISION_MAX_RPS.
+    rate_limiter.acquire()
     input_config = vision.InputConfig(content=pdf_content, mime_type='application/pdf')
     features = [vision.Feature(type_=vision.Feature.Type.DOCUMENT_TEXT_DETECTION)]
     request = vision.AnnotateFileRequest(input_config=input_config, features=features)
@@ -78,16 +181,132 @@ def ocr_pdf_content(pdf_content):
     return full_text
 
 
+def delete_staged_files(bucket, prefix):
+    """
+    Deletes everything under prefix in the bucket. Failures are printed rather than raised,
+    so a cleanup problem never hides the OCR result or the error that ended it.
+    """
+    try:
+        blobs = list(bucket.list_blobs(prefix=prefix))
+    except Exception as e:
+        print(f"Could not list staged files under gs://{GCS_BUCKET}/{prefix}: {e}")
+        return
+    for blob in blobs:
+        try:
+            blob.delete()
+        except Exception as e:
+            print(f"Could not delete gs://{GCS_BUCKET}/{blob.name}: {e}")
+
+
+def ocr_pdf_contents_async(client, storage_client, pdfs):
+    """
+    OCRs several PDFs with one asynchronous Vision request, staging them in GCS_BUCKET.
+    pdfs is a list of (pdf_id, pdf_content). Returns {pdf_id: text or Exception}.
+    """
+    bucket = storage_client.bucket(GCS_BUCKET)
+    prefix = f"vision-ocr/{uuid.uuid4().hex}"
+    features = [vision.Feature(type_=vision.Feature.Type.DOCUMENT_TEXT_DETECTION)]
+
+    try:
+        requests = []
+        for pdf_id, pdf_content in pdfs:
+            input_blob = f"{prefix}/input/{pdf_id}.pdf"
+            bucket.blob(input_blob).upload_from_string(pdf_content, content_type='application/pdf')
+            requests.append(vision.AsyncAnnotateFileRequest(
+                input_config=vision.InputConfig(
+                    gcs_source=vision.GcsSource(uri=f"gs://{GCS_BUCKET}/{input_blob}"), mime_type='application/pdf'
+                ),
+                features=features,
+                output_config=vision.OutputConfig(
+                    gcs_destination=vision.GcsDestination(uri=f"gs://{GCS_BUCKET}/{prefix}/output/{pdf_id}/"),
+                    batch_size=20,
+                ),
+            ))
+
+        operation = client.async_batch_annotate_files(requests=requests)
+        operation.result(timeout=VISION_ASYNC_TIMEOUT)
+
+        results = {}
+        for pdf_id, _ in pdfs:
+            # Vision writes one JSON file per 20 pages, named output-<first>-to-<last>.json.
+            blobs = list(bucket.list_blobs(prefix=f"{prefix}/output/{pdf_id}/"))
+            blobs.sort(key=lambda blob: int(re.search(r"output-(\d+)-to-", blob.name).group(1)))
+            try:
+                full_text = ""
+                for blob in blobs:
+                    for page in json.loads(blob.download_as_bytes())['responses']:
+                        if 'error' in page:
+                            raise Exception(page['error'].get('message', page['error']))
+                        full_text += page.get('fullTextAnnotation', {}).get('text', '')
+                if not blobs:
+                    raise Exception("Vision produced no output for this file")
+                results[pdf_id] = full_text
+            except Exception as e:
+                results[pdf_id] = e
+        return results
+    finally:
+        # Also runs when an upload fails part way, so nothing staged is left in the bucket.
+        delete_staged_files(bucket, prefix)
+
+
+def process_items(items, creds, vision_client, storage_client, rate_limiter):
+    """
+    Downloads a group of Drive PDFs and OCRs them. Runs on a worker thread.
+    Returns the (pdf_id, pdf_name, ocr_text, status) rows to save; the database is only touched by the main thread.
+    """
+    rows = []
+    downloaded = []
+    for item in items:
+        print(f"\n--- Processing '{item['name']}' ---")
+        try:
+            # 5. Download the file content into memory.
+            downloaded.append((item, download_pdf(creds, item['id'], item['name'])))
+        except Exception as e:
+            print(f"An ERROR occurred while downloading '{item['name']}': {e}")
+            rows.append((item['id'], item['name'], str(e), 'ocr_error'))
+
+    # 6. Send the content to the Vision API for OCR.
+    texts = {}
+    if downloaded and GCS_BUCKET:
+        print(f"Sending {len(downloaded)} files to Vision API for batch OCR...")
+        rate_limiter.acquire()
+        try:
+            texts = ocr_pdf_contents_async(vision_client, storage_client,
+                                           [(item['id'], content) for item, content in downloaded])
+        except Exception as e:
+            texts = {item['id']: e for item, _ in downloaded}
+    else:
+        for item, content in downloaded:
+            print(f"Sending '{item['name']}' to Vision API for OCR...")
+            try:
+                texts[item['id']] = ocr_pdf_content(vision_client, content, rate_limiter)
+            except Exception as e:
+                texts[item['id']] = e
+
+    for item, _ in downloaded:
+        pdf_id, pdf_name = item['id'], item['name']
+        extracted_text = texts.get(pdf_id, Exception("No OCR result returned"))
+        if isinstance(extracted_text, Exception):
+            # 8. If any step fails, record the error in the database.
+            print(f"An ERROR occurred while processing '{pdf_name}': {extracted_text}")
+            rows.append((pdf_id, pdf_name, str(extracted_text), 'ocr_error'))
+        else:
+            print(f"Successfully processed '{pdf_name}'.")
+            rows.append((pdf_id, pdf_name, extracted_text, 'ocr_complete'))
+    return rows
+
+
 # --- Main Script Execution ---
 if __name__ == "__main__":
     # 1. Prepare the database.
     setup_database()
-    conn = sqlite3.connect(DB_FILE)
+    conn = open_db(DB_FILE)
     cursor = conn.cursor()
 
     # 2. Get authorized access to Google Drive.
     print("Authenticating with Google Drive...")
-    drive_service = get_drive_service()
+    creds = get_drive_credentials()
+    drive_service = build('drive', 'v3', credentials=creds)
     print("Authentication successful.")
 
     # 3. Get the list of PDF files from the specified folder.
@@ -105,48 +324,41 @@ if __name__ == "__main__":
     else:
         print(f"Found {len(items)} PDF files. Starting processing...")
 
+        # 4. Skip files that have already been processed successfully.
+        to_process = []
         for item in items:
-            pdf_id = item['id']
-            pdf_name = item['name']
-
-            # 4. Check if the file has already been processed successfully.
-            cursor.execute("SELECT status FROM documents WHERE pdf_id = ?", (pdf_id,))
+            cursor.execute("SELECT status FROM documents WHERE pdf_id = ?", (item['id'],))
             result = cursor.fetchone()
             if result and result[0] == 'ocr_complete':
-                print(f"'{pdf_name}' has already been processed. Skipping.")
-                continue
+                print(f"'{item['name']}' has already been processed. Skipping.")
+            else:
+                to_process.append(item)
 
-            print(f"\n--- Processing '{pdf_name}' ---")
-            try:
-                # 5. Download the file content into memory.
-                request = drive_service.files().get_media(fileId=pdf_id)
-                fh = io.BytesIO()
-                downloader = MediaIoBaseDownload(fh, request)
-                done = False
-                while not done:
-                    status, done = downloader.next_chunk()
-                    print(f"Download {int(status.progress() * 100)}%.")
-
-                # 6. Send the content to the Vision API for OCR.
-                print("Sending to Vision API for OCR...")
-                extracted_text = ocr_pdf_content(fh.getvalue())
-
-                # 7. Save the successful result to the database.
-                cursor.execute(
-                    "INSERT OR REPLACE INTO documents (pdf_id, pdf_name, ocr_text, status) VALUES (?, ?, ?, ?)",
-                    (pdf_id, pdf_name, extracted_text, 'ocr_complete')
-                )
-                conn.commit()
-                print(f"Successfully processed and saved '{pdf_name}' to the database.")
+        vision_client = vision.ImageAnnotatorClient()
+        storage_client = None
+        if GCS_BUCKET:
+            # Only needed for async batches, so google-cloud-storage stays optional otherwise.
+            from google.cloud import storage
+            storage_client = storage.Client()
+        handle = partial(process_items, creds=creds, vision_client=vision_client,
+                         storage_client=storage_client, rate_limiter=RateLimiter(VISION_MAX_RPS))
 
-            except Exception as e:
-                # 8. If any step fails, record the error in the database.
-                print(f"An ERROR occurred while processing '{pdf_name}': {e}")
-                cursor.execute(
-                    "INSERT OR REPLACE INTO documents (pdf_id, pdf_name, ocr_text, status) VALUES (?, ?, ?, ?)",
-                    (pdf_id, pdf_name, str(e), 'ocr_error')
-                )
-                conn.commit()
+        # Synchronous Vision requests take one file each, so only group files for async batches.
+        group_size = VISION_FILES_PER_BATCH if GCS_BUCKET else 1
+        groups = [to_process[i:i + group_size] for i in range(0, len(to_process), group_size)]
+        pending_rows = []
+
+        try:
+            with ThreadPoolExecutor(max_workers=OCR_WORKERS) as executor:
+                for rows in executor.map(handle, groups):
+                    # 7. Queue the results; rows are committed in groups.
+                    pending_rows.extend(rows)
+                    # Errors are written right away so they are visible while the run continues.
+                    if any(row[3] == 'ocr_error' for row in rows) or len(pending_rows) >= DB_FLUSH_EVERY:
+                        flush_rows(conn, pending_rows)
+        finally:
+            # Save whatever is still queued, even if the run was interrupted.
+            flush_rows(conn, pending_rows)
 
     conn.close()
     print("\n✅ All processing complete.")
\ No newline at end of file
@@ -0,0 +1,71 @@
+import random
+
+from tenacity import retry, retry_if_exception, stop_after_attempt, wait_random_exponential
+from tenacity.wait import wait_base
+
+# Shared by the Gemini and Vision calls: up to 5 tries, waiting a random 0..2^n seconds
+# (capped at a minute) between them unless the server says how long to wait.
+MAX_ATTEMPTS = 5
+MAX_WAIT = 60
+# Added to a server-suggested wait so throttled callers don't all retry at the same instant.
+RETRY_AFTER_JITTER = 1.0
+
+
+def _parse_duration(value):
+    """Parses a JSON-encoded google.protobuf.Duration such as '37s' or '0.5s' into seconds."""
+    try:
+        return float(value[:-1]) if value.endswith('s') else None
+    except (AttributeError, ValueError):
+        return None
+
+
+def retry_after_seconds(exc):
+    """Returns the server-suggested wait in seconds from a throttling error, if any."""
+    details = getattr(exc, 'details', None)
+    # Gemini (google-genai) errors keep the JSON error body, whose google.rpc.RetryInfo
+    # entry holds it as retryDelay ...
+    if isinstance(details, dict):
+        error = details.get('error')
+        for detail in (error.get('details') if isinstance(error, dict) else None) or []:
+            delay = _parse_duration(detail.get('retryDelay')) if isinstance(detail, dict) else None
+            if delay is not None:
+                return delay
+    # ... Vision (gRPC) errors as a decoded RetryInfo detail ...
+    elif details:
+        for detail in details:
+            delay = getattr(detail, 'retry_delay', None)
+            if delay is not None:
+                return delay.seconds + delay.nanos / 1e9
+    # ... and other HTTP errors may send a Retry-After header.
+    response = getattr(exc, 'response', None)
+    headers = getattr(response, 'headers', None) or {}
+    try:
+        return float(headers.get('retry-after'))
+    except (TypeError, ValueError):
+        return None
+
+
+class wait_retry_after(wait_base):
+    """Waits as long as the server asked for plus some jitter, falling back to another wait strategy."""
+
+    def __init__(self, fallback):
+        self.fallback = fallback
+
+    def __call__(self, retry_state):
+        delay = retry_after_seconds(retry_state.outcome.exception())
+        if delay is None:
+            return self.fallback(retry_state)
+        return min(delay, MAX_WAIT) + random.uniform(0, RETRY_AFTER_JITTER)
+
+
+def transient_retry(is_transient):
+    """
+    Returns a decorator that retries the wrapped function, sync or async, while it fails
+    with an error is_transient accepts. Any other error, or the last failure, is raised as is.
+    """
+    return retry(
+        retry=retry_if_exception(is_transient),
+        wait=wait_retry_after(wait_random_exponential(multiplier=1, max=MAX_WAIT)),
+        stop=stop_after_attempt(MAX_ATTEMPTS),
+        reraise=True,
+    )
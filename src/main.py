@@ -1,18 +1,50 @@
 
 import argparse
+import csv
 import json
 import os
 import re
 import sys
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from functools import partial
 from pathlib import Path
-from typing import List, Dict, Any
+from typing import List, Dict, Any, Tuple
 
-# -------- PDF text extraction (pdfminer) --------
+# -------- PDF text extraction (pypdfium2 fast path, pdfminer fallback) --------
 from pdfminer.high_level import extract_pages
 from pdfminer.layout import LTTextContainer
 
+def _lazy_import_pdfium():
+    """Return the pypdfium2 module, or None if it is not installed."""
+    try:
+        import pypdfium2 as pdfium
+        return pdfium
+    except Exception:
+        return None
+
+# -------- Snippet JSONL encoding (orjson if installed, stdlib json otherwise) --------
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+# Output buffer for the snippets file, so thousands of small lines become a few large writes
+SNIPPET_BUFFER_SIZE = 1 << 20
+
+def _jsonl_line(obj: Dict[str, Any]) -> bytes:
+    """Encode one snippet as compact UTF-8 JSON plus newline; both encoders give the same bytes."""
+    if orjson is not None:
+        return orjson.dumps(obj, option=orjson.OPT_APPEND_NEWLINE)
+    return (json.dumps(obj, ensure_ascii=False, separators=(",", ":")) + "\n").encode("utf-8")
+
 # -------- Optional OCR imports (lazy) --------
+# LSTM engine, treat each page as one uniform block of text (faster than automatic layout analysis)
+TESSERACT_CONFIG = "--oem 1 --psm 6"
 def _lazy_import_ocr():
+    # Parallelism comes from running several single-threaded tesseract processes (see
+    # ocr_threads in main); tesseract's own OpenMP threads would oversubscribe the CPUs
+    os.environ.setdefault("OMP_THREAD_LIMIT", "1")
     try:
         import pytesseract  # requires system tesseract-ocr
     except Exception as e:
@@ -29,12 +61,86 @@ def _lazy_import_ocr():
         except Exception as e:
             raise RuntimeError("No PDF rasterizer available. Install 'pypdfium2' or 'pdf2image' + system poppler.") from e
 
+# -------- Patterns (compiled once, used for every page/block) --------
+# Tabs become spaces before runs of spaces are collapsed in find_candidate_blocks
+TAB_TO_SPACE = str.maketrans({"\t": " "})
+RE_CANDIDATE = re.compile(r"(Conditional\s+Use\s+Permit|Special\s+Use\s+Permit|Solar\b|Photovoltaic|2232)", re.I)
+# Cheap substring prefilter for RE_CANDIDATE: a page can only match if one of these occurs in it
+CANDIDATE_KEYWORDS = ("conditional", "special", "solar", "photovoltaic", "2232")
+# Non-ASCII letters re.I treats as equal to an 'i' or 's' in the keywords
+CANDIDATE_KEYWORD_FOLD = str.maketrans({"\u0130": "i", "\u0131": "i", "\u017f": "s"})
+# Single-valued fields: (field, pattern, named group holding the value, strip it?).
+# The first match of each field wins, same as running a separate search per field.
+FIELD_SPECS = [
+    # Applicant / Project
+    ("project_or_applicant", r"\b(?:Applicant|Application|Project)\s*[:\-]\s*(?P<project_or_applicant_value>[A-Z0-9\-\&\.,' ]{5,120})", "project_or_applicant_value", True),
+    # Capacity (MW)
+    ("mw", r"(?P<mw_value>\d{1,3}(?:\.\d+)?)\s*MW\b", "mw_value", False),
+    # Acres
+    ("acres", r"(?P<acres_value>\d{1,4}(?:\.\d+)?)\s*acre[s]?\b", "acres_value", False),
+    # Address / Parcel / PIN
+    ("location", r"\b(?:Location|Address|Parcel|Tax\s*Map|GPIN|PIN)\s*[:\-]\s*(?P<location_value>[^\n]{5,160})", "location_value", True),
+    # Outcome phrases
+    ("outcome_phrase", r"\b(?:approved|denied|recommend(?:ed)?\s+approval|recommend(?:ed)?\s+denial)\b", "outcome_phrase", False),
+    # Vote lines
+    ("vote_line", r"(?:roll\s*call\s*vote|vote\s*(?:was\s*)?(?:taken)?(?:\s*and\s*the\s*result[s]?\s*were)?)\s*[:\-]?\s*[^\n]{0,140}", "vote_line", True),
+    # Ayes/Nays lists
+    ("ayes", r"\b(?:Ayes?|Yeas?)\s*[:\-]\s*(?P<ayes_value>[^\n]+)", "ayes_value", True),
+    ("nays", r"\b(?:Nays?|Nos?)\s*[:\-]\s*(?P<nays_value>[^\n]+)", "nays_value", True),
+]
+# All fields in one scan. Each alternative sits in a lookahead so a match does not consume
+# text another field needs; no two fields can match at the same position, so the first hit
+# per field is the same one a separate search would find.
+# The leading class lists every character a field can start with, which lets the scan skip
+# most positions without trying each alternative.
+RE_FIELDS = re.compile(
+    r"(?=[\dAPLTGDRVYN])(?:" + "|".join(f"(?=(?P<{name}>{pattern}))" for name, pattern, _, _ in FIELD_SPECS) + ")",
+    re.I,
+)
+# CSV columns: file/page info, then every field extract_fields can produce, in FIELD_SPECS order.
+# The header is the same on every run. Output written with pandas ordered columns by first
+# appearance across rows and left out fields that never matched, so readers of older CSVs
+# should select columns by name, not position (e.g. vote_line now follows outcome_phrase).
+CSV_SCHEMA = ["filename", "relative_path", "meeting_date_guess", "page"] + \
+    [name for name, _, _, _ in FIELD_SPECS] + ["decision_factor_snippets"]
+RE_REASON = re.compile(r"([^.]{0,140}\b(concern|because|due to|reason|finding|finding[s]? of fact)[^.]{0,140})\.", re.I)
+RE_DATE_ISO = re.compile(r"(\d{4}[-_/\.]\d{1,2}[-_/\.]\d{1,2})")
+RE_DATE_US = re.compile(r"(\d{1,2}[-_/\.]\d{1,2}[-_/\.]\d{2,4})")
+
 # -------- Helpers --------
 def list_pdfs(input_dir: Path) -> List[Path]:
     return sorted([p for p in input_dir.rglob("*.pdf") if p.is_file()])
 
-def extract_pdf_text_per_page(pdf_path: Path) -> Dict[str, Any]:
-    """Return {'pages': [{'page_number': int, 'text': str}, ...]} or {'error': str}"""
+def _pdfium_text_per_page(pdf) -> List[Dict[str, Any]]:
+    """Text layer of every page of an open PDFium document, much faster than pdfminer."""
+    pages = []
+    for i, page in enumerate(pdf):
+        textpage = page.get_textpage()
+        # PDFium separates lines with \r\n; the field patterns expect \n
+        text = textpage.get_text_range().replace("\r\n", "\n")
+        textpage.close()
+        page.close()
+        pages.append({"page_number": i+1, "text": text})
+    return pages
+
+def extract_pdf_text_per_page(pdf_path: Path, pdf=None) -> Dict[str, Any]:
+    """Return {'pages': [{'page_number': int, 'text': str}, ...]} or {'error': str}
+    Pass an already open pypdfium2 document as `pdf` to avoid parsing the file again."""
+    pdfium = _lazy_import_pdfium()
+    if pdf is not None:
+        try:
+            return {"pages": _pdfium_text_per_page(pdf)}
+        except Exception:
+            pass  # fall back to pdfminer
+    elif pdfium is not None:
+        try:
+            doc = pdfium.PdfDocument(str(pdf_path))
+            try:
+                return {"pages": _pdfium_text_per_page(doc)}
+            finally:
+                doc.close()
+        except Exception:
+            pass  # fall back to pdfminer
     pages = []
     try:
         for pageno, page_layout in enumerate(extract_pages(str(pdf_path))):
@@ -48,33 +154,55 @@ def extract_pdf_text_per_page(pdf_path: Path) -> Dict[str, Any]:
         return {"error": f"pdfminer parse failed: {e}"}
     return {"pages": pages}
 
-def ocr_pdf_pages(pdf_path: Path) -> List[str]:
-    """OCR all pages -> list of strings (one per page). Only used if --ocr passed."""
+def ocr_pdf_pages(pdf_path: Path, pdf=None, threads: int = 1) -> List[str]:
+    """OCR all pages -> list of strings (one per page). Only used if --ocr passed.
+    Pass an already open pypdfium2 document as `pdf` to avoid parsing the file again.
+    Up to `threads` pages are OCR'd at once, each by its own tesseract subprocess."""
     pytesseract, raster = _lazy_import_ocr()
     texts = []
     # Prefer pypdfium2 path
     try:
         import pypdfium2 as pdfium
-        pdf = pdfium.PdfDocument(str(pdf_path))
-        for i in range(len(pdf)):
-            page = pdf.get_page(i)
-            pil = page.render(scale=2).to_pil()  # 2x scale for better OCR
-            txt = pytesseract.image_to_string(pil)
-            texts.append(txt)
+        doc = pdf if pdf is not None else pdfium.PdfDocument(str(pdf_path))
+        try:
+            # PDFium is not thread-safe, so pages are rendered here one at a time while
+            # earlier pages are OCR'd in the pool; only a few rendered pages are kept in memory
+            with ThreadPoolExecutor(max_workers=threads) as ex:
+                pending = deque()
+                for i in range(len(doc)):
+                    if len(pending) >= 2 * threads:
+                        texts.append(pending.popleft().result())
+                    page = doc.get_page(i)
+                    pil = page.render(scale=2).to_pil()  # 2x scale for better OCR
+                    page.close()
+                    pending.append(ex.submit(pytesseract.image_to_string, pil, config=TESSERACT_CONFIG))
+                texts.extend(f.result() for f in pending)
+        finally:
+            if doc is not pdf:
+                doc.close()
         return texts
     except Exception:
-        pass
+        texts = []
     # Fallback: pdf2image
     try:
         from pdf2image import convert_from_path
         images = convert_from_path(str(pdf_path), dpi=300)
-        for img in images:
-            txt = pytesseract.image_to_string(img)
-            texts.append(txt)
+        with ThreadPoolExecutor(max_workers=threads) as ex:
+            texts = list(ex.map(lambda img: pytesseract.image_to_string(img, config=TESSERACT_CONFIG), images))
         return texts
     except Exception as e:
         raise RuntimeError(f"OCR rasterization failed: {e}")
 
+def _has_candidate_keyword(txt: str) -> bool:
+    """Fast check that rejects pages RE_CANDIDATE cannot match."""
+    lower = txt.lower()
+    if any(k in lower for k in CANDIDATE_KEYWORDS):
+        return True
+    if txt.isascii():
+        return False
+    lower = txt.translate(CANDIDATE_KEYWORD_FOLD).lower()
+    return any(k in lower for k in CANDIDATE_KEYWORDS)
+
 def find_candidate_blocks(pages: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
     """Identify pages likely to contain CUP/solar content."""
     cands = []
@@ -82,48 +210,35 @@ def find_candidate_blocks(pages: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
         txt = p.get("text") or ""
         if not txt.strip():
             continue
-        t = re.sub(r"[ \t]+", " ", txt)
-        if re.search(r"(Conditional\s+Use\s+Permit|Special\s+Use\s+Permit|Solar\b|Photovoltaic|2232)", t, re.I):
+        # Most pages mention none of the keywords; skip them before any regex work
+        if not _has_candidate_keyword(txt):
+            continue
+        # Same result as re.sub(r"[ \t]+", " ", txt), but str.translate/replace stay in C
+        t = txt.translate(TAB_TO_SPACE)
+        while "  " in t:
+            t = t.replace("  ", " ")
+        if RE_CANDIDATE.search(t):
             cands.append({"page": p["page_number"], "text": t})
     return cands
 
 def extract_fields(text: str) -> Dict[str, Any]:
     """Extract structured fields from a candidate text block."""
+    found = {}
+    for m in RE_FIELDS.finditer(text):
+        # The field's outer group closes last, so it is the match's lastgroup.
+        if m.lastgroup not in found:
+            found[m.lastgroup] = m
+            if len(found) == len(FIELD_SPECS):
+                break
+    # Keep the usual field order (it decides the CSV column order)
     fields = {}
-    # Applicant / Project
-    m = re.search(r"\b(Applicant|Application|Project)\s*[:\-]\s*([A-Z0-9\-\&\.,' ]{5,120})", text, re.I)
-    if m:
-        fields["project_or_applicant"] = m.group(2).strip()
-    # Capacity (MW)
-    m = re.search(r"(\d{1,3}(?:\.\d+)?)\s*MW\b", text, re.I)
-    if m:
-        fields["mw"] = m.group(1)
-    # Acres
-    m = re.search(r"(\d{1,4}(?:\.\d+)?)\s*acre[s]?\b", text, re.I)
-    if m:
-        fields["acres"] = m.group(1)
-    # Address / Parcel / PIN
-    m = re.search(r"\b(Location|Address|Parcel|Tax\s*Map|GPIN|PIN)\s*[:\-]\s*([^\n]{5,160})", text, re.I)
-    if m:
-        fields["location"] = m.group(2).strip()
-    # Outcome phrases
-    m = re.search(r"\b(approved|denied|recommend(?:ed)?\s+approval|recommend(?:ed)?\s+denial)\b", text, re.I)
-    if m:
-        fields["outcome_phrase"] = m.group(0)
-    # Vote lines
-    v = re.search(r"(roll\s*call\s*vote|vote\s*(?:was\s*)?(?:taken)?(?:\s*and\s*the\s*result[s]?\s*were)?)\s*[:\-]?\s*[^\n]{0,140}", text, re.I)
-    if v:
-        fields["vote_line"] = v.group(0).strip()
-    # Ayes/Nays lists
-    ayes = re.search(r"\b(Ayes?|Yeas?)\s*[:\-]\s*([^\n]+)", text, re.I)
-    nays = re.search(r"\b(Nays?|Nos?)\s*[:\-]\s*([^\n]+)", text, re.I)
-    if ayes:
-        fields["ayes"] = ayes.group(2).strip()
-    if nays:
-        fields["nays"] = nays.group(2).strip()
+    for name, _, value_group, strip in FIELD_SPECS:
+        if name in found:
+            value = found[name].group(value_group)
+            fields[name] = value.strip() if strip else value
     # Reasons / concerns
     reasons = []
-    for m in re.finditer(r"([^.]{0,140}\b(concern|because|due to|reason|finding|finding[s]? of fact)[^.]{0,140})\.", text, re.I):
+    for m in RE_REASON.finditer(text):
         reasons.append(m.group(0).strip())
         if len(reasons) >= 3:
             break
@@ -132,20 +247,77 @@ def extract_fields(text: str) -> Dict[str, Any]:
     return fields
 
 def guess_meeting_date_from_name(name: str) -> str:
-    m = re.search(r"(\d{4}[-_/\.]\d{1,2}[-_/\.]\d{1,2})", name)
+    m = RE_DATE_ISO.search(name)
     if m:
         return m.group(1)
-    m = re.search(r"(\d{1,2}[-_/\.]\d{1,2}[-_/\.]\d{2,4})", name)
+    m = RE_DATE_US.search(name)
     if m:
         return m.group(1)
     return ""
 
+def process_pdf(pdf_path: Path, input_dir: Path, ocr_enabled: bool, ocr_threads: int = 1) -> Tuple[List[Dict[str, Any]], List[Dict[str, Any]]]:
+    """Extract (records, snippets) from one PDF. Runs in a worker process; returns empty lists on failure."""
+    records, snippets = [], []
+    pdf = None
+    try:
+        # Open the document once and share it between text extraction and OCR
+        pdfium = _lazy_import_pdfium()
+        if pdfium is not None:
+            try:
+                pdf = pdfium.PdfDocument(str(pdf_path))
+            except Exception:
+                pdf = None  # let pdfminer have a go
+
+        res = extract_pdf_text_per_page(pdf_path, pdf)
+        pages = res.get("pages", [])
+        # OCR fallback per page if requested and text is weak
+        if ocr_enabled and (not pages or sum(len(p.get('text') or "") for p in pages) < 500):
+            try:
+                ocr_texts = ocr_pdf_pages(pdf_path, pdf, ocr_threads)
+                pages = [{"page_number": i+1, "text": ocr_texts[i] if i < len(ocr_texts) else ""} for i in range(len(ocr_texts))]
+            except Exception as e:
+                # keep existing pages if OCR fails
+                pass
+
+        cands = find_candidate_blocks(pages)
+        if not cands:
+            return records, snippets
+
+        meeting_date = guess_meeting_date_from_name(pdf_path.name)
+        for blk in cands:
+            fields = extract_fields(blk["text"] or "")
+            if not fields:
+                continue
+            record = {
+                "filename": pdf_path.name,
+                "relative_path": str(pdf_path.relative_to(input_dir)),
+                "meeting_date_guess": meeting_date,
+                "page": blk["page"],
+            }
+            record.update(fields)
+            records.append(record)
+            # snippets
+            snippets.append({
+                "filename": pdf_path.name,
+                "page": blk["page"],
+                "text_snippet": (blk["text"] or "")[:1000]
+            })
+
+    except Exception as e:
+        # continue with next file
+        return [], []
+    finally:
+        if pdf is not None:
+            pdf.close()
+    return records, snippets
+
 def main():
     ap = argparse.ArgumentParser()
     ap.add_argument("--input_dir", required=True, help="Directory containing PDFs (recursively processed)")
     ap.add_argument("--out_csv", required=True, help="Output CSV path")
     ap.add_argument("--out_snippets", required=True, help="Output JSONL path with snippets for audit")
     ap.add_argument("--ocr", action="store_true", help="Enable OCR fallback for pages with little/no text")
+    ap.add_argument("--workers", type=int, default=os.cpu_count(), help="Number of PDFs to process in parallel (default: CPU count)")
     args = ap.parse_args()
 
     input_dir = Path(args.input_dir)
@@ -168,53 +340,25 @@ def main():
             print(f"[OCR] {e}", file=sys.stderr)
             sys.exit(2)
 
-    rows = []
-    with out_snippets.open("w", encoding="utf-8") as snipf:
-        for idx, pdf_path in enumerate(pdf_paths, start=1):
-            try:
-                res = extract_pdf_text_per_page(pdf_path)
-                pages = res.get("pages", [])
-                # OCR fallback per page if requested and text is weak
-                if args.ocr and (not pages or sum(len(p.get('text') or "") for p in pages) < 500):
-                    try:
-                        ocr_texts = ocr_pdf_pages(pdf_path)
-                        pages = [{"page_number": i+1, "text": ocr_texts[i] if i < len(ocr_texts) else ""} for i in range(len(ocr_texts))]
-                    except Exception as e:
-                        # keep existing pages if OCR fails
-                        pass
-
-                cands = find_candidate_blocks(pages)
-                if not cands:
-                    continue
-
-                meeting_date = guess_meeting_date_from_name(pdf_path.name)
-                for blk in cands:
-                    fields = extract_fields(blk["text"] or "")
-                    if not fields:
-                        continue
-                    record = {
-                        "filename": pdf_path.name,
-                        "relative_path": str(pdf_path.relative_to(input_dir)),
-                        "meeting_date_guess": meeting_date,
-                        "page": blk["page"],
-                    }
-                    record.update(fields)
-                    rows.append(record)
-                    # snippets
-                    snip = {
-                        "filename": pdf_path.name,
-                        "page": blk["page"],
-                        "text_snippet": (blk["text"] or "")[:1000]
-                    }
-                    snipf.write(json.dumps(snip) + "\n")
-
-            except Exception as e:
-                # continue with next file
-                continue
+    n_rows = 0
+    # Each PDF is independent and CPU-bound, so spread them over processes.
+    # map() keeps results in input order, so the output is the same on every run.
+    # Split the cores between worker processes and the tesseract runs inside each of them
+    ocr_threads = max(1, (os.cpu_count() or 1) // max(1, args.workers))
+    worker = partial(process_pdf, input_dir=input_dir, ocr_enabled=args.ocr, ocr_threads=ocr_threads)
+    with out_csv.open("w", encoding="utf-8", newline="") as csvf, \
+            out_snippets.open("wb", buffering=SNIPPET_BUFFER_SIZE) as snipf, \
+            ProcessPoolExecutor(max_workers=args.workers) as ex:
+        # Rows are streamed out as each file finishes instead of being held in memory
+        writer = csv.DictWriter(csvf, fieldnames=CSV_SCHEMA, extrasaction="ignore", lineterminator="\n")
+        writer.writeheader()
+        for records, snippets in ex.map(worker, pdf_paths):
+            writer.writerows(records)
+            n_rows += len(records)
+            for snip in snippets:
+                snipf.write(_jsonl_line(snip))
 
-    import pandas as pd
-    pd.DataFrame(rows).to_csv(out_csv, index=False)
-    print(f"Wrote {len(rows)} records to {out_csv}")
+    print(f"Wrote {n_rows} records to {out_csv}")
     print(f"Snippets written to {out_snippets}")
 
 if __name__ == "__main__":